@@ -4,8 +4,7 @@ import sys
 import argparse
 import socket
 import serial
-import select
-import io
+import selectors
 import os
 import time
 import datetime
@@ -17,34 +16,92 @@ from py_linenoise import linenoise
 
 APP_DATA_DIR = os.path.join(pathlib.Path.home(), ".jterm")
 HISTORY_FILE = os.path.join(APP_DATA_DIR, "history.txt")
+LOG_BUFFER_SIZE = 1 << 16
+READ_CHUNK_SIZE = 16384
+MAX_READS_PER_WAKEUP = 16
+
+
+ANSI_RESET = "\x1b[0m"
+
+# From:
+# https://stackoverflow.com/questions/14693701/how-can-i-remove-the-ansi-escape-sequences-from-a-string-in-python
+# 7-bit C1 ANSI sequences
+_ANSI_ESCAPE_BYTES_RE = re.compile(
+    rb"""
+    \x1B  # ESC
+    (?:   # 7-bit C1 Fe (except CSI)
+        [@-Z\\-_]
+    |     # or [ for CSI, followed by a control sequence
+        \[
+        [0-?]*  # Parameter bytes
+        [ -/]*  # Intermediate bytes
+        [@-~]   # Final byte
+    )
+""",
+    re.VERBOSE,
+)
 
 
 class LineBuf:
+    __slots__ = ("buf", "eol", "_read_pos", "_scan_pos")
+
+    # Consumed bytes are only dropped from the front of the buffer once this
+    # many have accumulated, so reading a line doesn't copy the unread tail.
+    COMPACT_THRESHOLD = 65536
+
     def __init__(self):
-        self.buf = io.BytesIO()
+        self.buf = bytearray()
         self.eol = b"\n"
+        self._read_pos = 0
+        # Position from which the buffer has not yet been searched for eol.
+        self._scan_pos = 0
 
     def write(self, data):
-        self.buf.write(data)
-
-    def has_line(self):
-        return self.buf.getvalue().find(self.eol) >= 0
+        self.buf.extend(data)
 
-    def readline(self):
-        data = self.buf.getvalue()
-        pos = data.find(self.eol)
+    def drain_lines(self):
+        """return a list of all complete lines in the buffer"""
+        pos = self.buf.find(self.eol, max(self._read_pos, self._scan_pos))
         if pos == -1:
-            return None
-        line = data[0:pos]
-        self.buf = io.BytesIO(data[pos + len(self.eol) :])
-        self.buf.seek(0, os.SEEK_END)
-        return line
+            self._scan_pos = len(self.buf) - len(self.eol) + 1
+            return []
+        last = self.buf.rfind(self.eol, pos)
+        lines = bytes(memoryview(self.buf)[self._read_pos : last]).split(self.eol)
+        self._read_pos = last + len(self.eol)
+        # rfind has already searched the partial line after the last eol.
+        self._scan_pos = len(self.buf) - len(self.eol) + 1
+        if self._read_pos > self.COMPACT_THRESHOLD:
+            del self.buf[: self._read_pos]
+            self._scan_pos = max(0, self._scan_pos - self._read_pos)
+            self._read_pos = 0
+        return lines
 
 
 class Interface:
+    __slots__ = ("_rx_buf", "_rx_view")
+
+    def __init__(self):
+        self._rx_buf = bytearray(READ_CHUNK_SIZE)
+        self._rx_view = memoryview(self._rx_buf)
+
     def read(self, size):
         raise NotImplementedError()
 
+    def readinto(self, buf):
+        """read what is available into buf without blocking
+
+        Returns the number of bytes read, 0 if the interface was closed.
+        """
+        raise NotImplementedError()
+
+    def read_chunk(self):
+        """read into the receive buffer and return a view of the data read
+
+        The view is only valid until the next call.
+        """
+        n = self.readinto(self._rx_view)
+        return self._rx_view[:n]
+
     def write(self, data):
         raise NotImplementedError()
 
@@ -65,7 +122,10 @@ class Interface:
 
 
 class SerialInterface(Interface):
+    __slots__ = ("_port", "_baudrate", "_timeout_s", "dev", "_fd")
+
     def __init__(self, port, baudrate):
+        super().__init__()
         self._port = port
         self._baudrate = baudrate
         self._timeout_s = 0
@@ -76,6 +136,13 @@ class SerialInterface(Interface):
         except serial.SerialException:
             return b""
 
+    def readinto(self, buf):
+        # pyserial keeps the port in non-blocking mode, so this never waits.
+        try:
+            return os.readv(self._fd, (buf,))
+        except OSError:
+            return 0
+
     def write(self, data):
         self.dev.write(data)
 
@@ -86,6 +153,7 @@ class SerialInterface(Interface):
         self.dev = serial.Serial(
             port=self._port, baudrate=self._baudrate, timeout=self._timeout_s
         )
+        self._fd = self.dev.fileno()
 
     def close(self):
         self.dev.close()
@@ -116,7 +184,17 @@ class SerialInterface(Interface):
 
 
 class SocketInterface(Interface):
+    __slots__ = (
+        "_host",
+        "_port",
+        "_timeout_s",
+        "timeout_s",
+        "dev",
+        "_fd",
+    )
+
     def __init__(self, host, port, timeout_s):
+        super().__init__()
         self._host = host
         self._port = port
         self._timeout_s = timeout_s
@@ -129,6 +207,14 @@ class SocketInterface(Interface):
         except socket.timeout:
             return b""
 
+    def readinto(self, buf):
+        # A socket with a timeout is non-blocking at the fd level, so reading
+        # the fd directly never waits for the timeout (unlike recv_into).
+        try:
+            return os.readv(self._fd, (buf,))
+        except OSError:
+            return 0
+
     def write(self, data):
         self.dev.send(data)
 
@@ -139,6 +225,7 @@ class SocketInterface(Interface):
         self.dev = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.dev.settimeout(self._timeout_s)
         self.dev.connect((self._host, self._port))
+        self._fd = self.dev.fileno()
 
     def close(self):
         self.dev.close()
@@ -185,81 +272,126 @@ def hints(s):
 
 def eol_option_as_bytestring(eol_option):
     eol_alternatives = {
-        "lf": "\n",
-        "crlf": "\r\n",
-        "cr": "\r",
+        "lf": b"\n",
+        "crlf": b"\r\n",
+        "cr": b"\r",
     }
     return eol_alternatives[eol_option]
 
 
-def process_cmd(cmdline, interface, log_file, args):
+# Single byte bytes objects, indexed by their value.
+SINGLE_BYTES = tuple(bytes((b,)) for b in range(256))
+
+
+def process_cmd(cmdline, interface, log_file, eol, args):
     if log_file is not None:
         log_file.write(cmdline + "\n")
 
+    payload = cmdline.encode()
+    if args.delay_between_byte_ms == 0 and args.delay_before_eol_ms == 0:
+        # No delays within the command, send it all in one go.
+        interface.write(payload + eol)
+        time.sleep(args.delay_after_eol_ms / 1000)
+        return
+
     if args.delay_between_byte_ms > 0:
-        for b in cmdline.encode():
-            interface.write(bytes([b]))
+        for b in payload:
+            interface.write(SINGLE_BYTES[b])
             time.sleep(args.delay_between_byte_ms / 1000)
     else:
-        interface.write(cmdline.encode())
+        interface.write(payload)
     time.sleep(args.delay_before_eol_ms / 1000)
-    eol = eol_option_as_bytestring(args.eol)
-    for b in eol.encode():
-        interface.write(bytes([b]))
+    for b in eol:
+        interface.write(SINGLE_BYTES[b])
         time.sleep(args.delay_between_byte_ms / 1000)
     time.sleep(args.delay_after_eol_ms / 1000)
 
 
-def remove_ansi_escape_codes(s):
-    # From:
-    # https://stackoverflow.com/questions/14693701/how-can-i-remove-the-ansi-escape-sequences-from-a-string-in-python
-    # 7-bit C1 ANSI sequences
-    ansi_escape = re.compile(
-        r"""
-        \x1B  # ESC
-        (?:   # 7-bit C1 Fe (except CSI)
-            [@-Z\\-_]
-        |     # or [ for CSI, followed by a control sequence
-            \[
-            [0-?]*  # Parameter bytes
-            [ -/]*  # Intermediate bytes
-            [@-~]   # Final byte
-        )
-    """,
-        re.VERBOSE,
-    )
-    return ansi_escape.sub("", s)
+class _NonPrintableTable(dict):
+    """str.translate() table that escapes non-printable characters
+
+    Code points below 256 are filled in up front. Higher ones are computed
+    on each lookup and not stored, so the table doesn't grow with the data.
+    """
+
+    def __init__(self, accept):
+        super().__init__()
+        self._accept = accept
+        for i in range(256):
+            self[i] = self._escape(i)
+
+    def _escape(self, i):
+        c = chr(i)
+        if c in self._accept:
+            return c
+        if c == "\\":
+            return "\\\\"
+        if c.isprintable():
+            return c
+        return f"\\x{i:02x}"
+
+    def __missing__(self, i):
+        return self._escape(i)
+
+
+_NON_PRINTABLE_TABLE = _NonPrintableTable("")
+_NON_PRINTABLE_TABLE_KEEP_ESC = _NonPrintableTable("\x1b")
+
+
+def replace_non_printable(s):
+    return s.translate(_NON_PRINTABLE_TABLE)
+
+
+def replace_non_printable_keep_esc(s):
+    return s.translate(_NON_PRINTABLE_TABLE_KEEP_ESC)
+
 
+def sanitize_for_log(line):
+    """return the line without ANSI escape codes and non-printable characters
 
-def replace_non_printable(s, accept=""):
-    s_out = []
-    for c in s:
-        if c in accept:
-            s_out.append(c)
-        elif c == "\\":
-            s_out.append("\\\\")
-        elif c.isprintable():
-            s_out.append(c)
-        else:
-            s_out.append(f"\\x{ord(c):02x}")
-    return "".join(s_out)
+    The escape codes are removed before decoding, as they are plain ASCII.
+    """
+    if b"\x1b" in line:
+        line = _ANSI_ESCAPE_BYTES_RE.sub(b"", line)
+    return replace_non_printable(line.decode(errors="replace"))
 
 
-def print_line(line, log_file):
-    time = datetime.datetime.now().isoformat(timespec="milliseconds")
+# The formatted date and time of the last second a timestamp was made for.
+_TIMESTAMP_CACHE = [None, ""]
+
+
+def timestamp_now():
+    """return the local time in ISO 8601 format with milliseconds"""
+    t = time.time()
+    sec = int(t)
+    if _TIMESTAMP_CACHE[0] != sec:
+        _TIMESTAMP_CACHE[0] = sec
+        _TIMESTAMP_CACHE[1] = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(sec))
+    return f"{_TIMESTAMP_CACHE[1]}.{int((t - sec) * 1000):03d}"
+
+
+def format_line(line, log_file):
+    """return the line as printed to the terminal and as written to the log
+
+    The log string is None when there is no log file.
+    """
+    time = timestamp_now()
+    line = line.translate(None, b"\r")
     s = line.decode(errors="replace")
-    s = s.replace("\r", "")
     ESC = "\x1b"
-    s_print = replace_non_printable(s, ESC)
-    if ESC in s:
-        s_print = s_print + ESC + "[0m"
-    print(f"{time} {s_print}")
+    has_esc = ESC in s
+    s_print = replace_non_printable_keep_esc(s)
+    if has_esc and not s_print.endswith(ANSI_RESET):
+        s_print = s_print + ANSI_RESET
+    s_log = None
     if log_file is not None:
-        s_log = replace_non_printable(remove_ansi_escape_codes(s))
-        log_file.write(f"{time} {s_log}\n")
+        # Without ESC, the two escape tables give the same result.
+        s_log = sanitize_for_log(line) if has_esc else s_print
+        s_log = f"{time} {s_log}\n"
+    return f"{time} {s_print}\n", s_log
 
 
-def process_input(ln, line_state, interface, log_file, prompt, args):
+def process_input(ln, line_state, interface, log_file, prompt, eol, args):
     res = ln.edit_feed(line_state)
     if res == linenoise.EditResult.MORE:
         pass
@@ -272,7 +404,7 @@ def process_input(ln, line_state, interface, log_file, prompt, args):
         ln.edit_stop(line_state)
         cmdline = str(line_state)
         ln.history_add(cmdline)
-        process_cmd(cmdline, interface, log_file, args)
+        process_cmd(cmdline, interface, log_file, eol, args)
         line_state = ln.edit_start(prompt)
     elif res == linenoise.EditResult.HOTKEY:
         ln.edit_stop(line_state)
@@ -285,15 +417,40 @@ def process_input(ln, line_state, interface, log_file, prompt, args):
     return line_state
 
 
+def write_stdout(s):
+    # Anything already written through the text layer must come out first.
+    sys.stdout.flush()
+    sys.stdout.buffer.write(s.encode(sys.stdout.encoding, errors="replace"))
+    sys.stdout.buffer.flush()
+
+
 def process_interface(line_state, line_buf, interface, log_file):
-    data = interface.read(1024)
-    if not data:
-        return False
-    line_buf.write(data)
-    if line_buf.has_line():
+    # Drain what is pending (up to a limit) so that a burst of data is
+    # printed in one go. The interface is readable, so an empty first read
+    # means that it has been closed.
+    for i in range(MAX_READS_PER_WAKEUP):
+        data = interface.read_chunk()
+        if not data:
+            if i == 0:
+                return False
+            break
+        line_buf.write(data)
+        if len(data) < READ_CHUNK_SIZE:
+            break
+    lines = line_buf.drain_lines()
+    if lines:
+        parts = []
+        log_parts = []
+        for line in lines:
+            s_print, s_log = format_line(line, log_file)
+            parts.append(s_print)
+            if s_log is not None:
+                log_parts.append(s_log)
         line_state.hide()
-        while (line := line_buf.readline()) is not None:
-            print_line(line, log_file)
+        write_stdout("".join(parts))
+        if log_file is not None:
+            log_file.write("".join(log_parts))
+            log_file.flush()
         line_state.show()
     return True
 
@@ -322,38 +479,52 @@ def interactive(interface, log_file, args):
     ln.set_hints_callback(hints)
 
     # Load history from file. The history file is a plain text file
-    # where entries are separated by newlines.
+    # where entries are separated by newlines. Its directory is created
+    # here rather than when saving, to keep that off the exit path.
+    os.makedirs(os.path.dirname(HISTORY_FILE), exist_ok=True)
     ln.history_load(HISTORY_FILE)
 
     ln.set_hotkey(linenoise._KEY_CTRL_L)
 
     prompt = "> "
+    eol = eol_option_as_bytestring(args.eol)
     line_state = ln.edit_start(prompt)
+    sel = selectors.DefaultSelector()
+    sel.register(line_state.ifd, selectors.EVENT_READ, data="stdin")
+    sel.register(interface.fileno(), selectors.EVENT_READ, data="interface")
     try:
         while True:
-            fds = (line_state.ifd, interface.fileno())
-            (rd, _, _) = select.select(fds, (), ())
-            if line_state.ifd in rd:
-                # Data is available on stdin (or EOF).
-                line_state = process_input(
-                    ln, line_state, interface, log_file, prompt, args
-                )
-            if interface.fileno() in rd:
+            for key, _ in sel.select():
+                if key.data == "stdin":
+                    # Data is available on stdin (or EOF).
+                    line_state = process_input(
+                        ln, line_state, interface, log_file, prompt, eol, args
+                    )
+                    if line_state.ifd != key.fd:
+                        # A new edit was started on another input fd.
+                        sel.unregister(key.fd)
+                        sel.register(line_state.ifd, selectors.EVENT_READ, data="stdin")
+                    continue
                 # Data is available at our interface (or EOF).
                 got_data = process_interface(line_state, line_buf, interface, log_file)
                 if not got_data:
                     line_state.hide()
                     print(f"Interface {interface} closed. Will retry to open it.")
+                    sel.unregister(key.fd)
                     interface.close()
                     interface.try_open()
+                    sel.register(
+                        interface.fileno(), selectors.EVENT_READ, data="interface"
+                    )
                     line_state.show()
     except EOFError:
         ln.edit_stop(line_state)
-        os.makedirs(os.path.dirname(HISTORY_FILE), exist_ok=True)
         ln.history_save(HISTORY_FILE)
     except:
         ln.edit_stop(line_state)
         raise
+    finally:
+        sel.close()
 
 
 def split_host_and_port(host_colon_port):
@@ -461,8 +632,12 @@ def main():
     if args.log:
         print(f"Appending to log file: '{args.log}'")
         os.makedirs(os.path.dirname(args.log), exist_ok=True)
-        log_file = open(args.log, "a")
-    interactive(interface, log_file, args)
+        log_file = open(args.log, "a", buffering=LOG_BUFFER_SIZE, encoding="utf-8")
+    try:
+        interactive(interface, log_file, args)
+    finally:
+        if log_file is not None:
+            log_file.close()
 
 
 if __name__ == "__main__":